@@ -2,45 +2,91 @@
 """
 Pipeline para extraer especies con uso precolombino de PDFs,
 con logging DEBUG que se escribe tanto en consola como en un archivo.
-Requiere: Ollama en localhost:11434 y un modelo que acepte salida estructurada (por ejemplo, deepseek‑r1:8b).
+Requiere: Ollama en localhost:11434 (o en $OLLAMA_HOST) y un modelo que acepte salida estructurada (por ejemplo, deepseek‑r1:8b).
 """
 # ╭──────────── IMPORTS ────────────╮
 import os
+import io
 import sys
 import re
-import json
+import pickle
+import hashlib
 import logging
+import atexit
 import subprocess
-import unicodedata
+import tempfile
+from bisect import bisect_left
+from itertools import chain
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from logging.handlers import QueueHandler, QueueListener
 from textwrap import shorten
-from typing import List, Dict, Any, Generator
+from typing import List, Dict, Any, Generator, Iterable, Iterator, Optional, Tuple
 
+# Un hilo de OpenMP por proceso de Tesseract: el paralelismo lo da el pool.
+# OpenMP lee la variable al cargarse con tesserocr, así que debe ir antes del import.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+import httpx
+import ijson
+import numpy as np
 import ollama
-import pdfplumber
+import orjson
+import pypdfium2 as pdfium
 from pdf2image import convert_from_path
-import pytesseract
+from PIL import Image
+from tesserocr import PyTessBaseAPI
 import pandas as pd
 from tqdm.auto import tqdm
+import zstandard as zstd
 # ╰─────────────────────────────────╯
 
-# ╭── instalar openpyxl si falta (para .xlsx) ─╮
+# ╭─ instalar xlsxwriter si falta (para .xlsx) ─╮
 try:
-    import openpyxl  # noqa: F401
+    import xlsxwriter
 except ModuleNotFoundError:
-    print("Instalando openpyxl …")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "--quiet", "openpyxl"])
-# ╰────────────────────────────────────────────╯
+    print("Instalando xlsxwriter …")
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "--quiet", "xlsxwriter"])
+    import xlsxwriter
+# ╰─────────────────────────────────────────────╯
 
 # ╭───────── CONFIGURACIÓN GENERAL ─────────╮
 PDF_DIR    = "data_pdf"
 OUTPUT_DIR = "outputs"
 OUT_FILE   = os.path.join(OUTPUT_DIR, "especies_precolombinas_debug.xlsx")
+JSONL_PATH = os.path.join(OUTPUT_DIR, "especies.jsonl")      # registros según se producen
 LOG_PATH   = os.path.join(OUTPUT_DIR, "extractor_especies_debug.log")
+CACHE_PATH = os.path.join(OUTPUT_DIR, "llm_cache.pkl")
+CHUNK_CACHE_PATH = os.path.join(OUTPUT_DIR, "chunk_cache.json")
+CACHE_PARTE      = "cache_parte."         # outputs/cache_parte.<pid>.pkl: novedades de cada proceso
+TEXT_CACHE_DIR   = os.path.join(OUTPUT_DIR, "cache")          # texto limpio por PDF (.txt.zst)
+LIMPIEZA_VERSION = 2      # súbela si cambia clean_text: invalida la caché de texto
+NORMALIZA_VERSION = 1     # súbela si cambia normaliza_registros: invalida chunk_cache.json
 
 #MODEL_ID   = "deepseek-r1:8b"   # Ajusta al modelo que tengas descargado
-MODEL_ID   = "olmo2:7b"
+MODEL_ID   = "olmo2:7b-1124-instruct-q4_K_M"   # cuantizado a 4 bits (ollama pull ...)
 TESS_LANG  = "spa+eng"
-CHUNK_SIZE = 4_000
+BLANCO_STD   = 5.0        # desviación típica de grises bajo la cual la página está en blanco
+BLANCO_TINTA = 0.005      # fracción mínima de píxeles oscuros (<128) para intentar OCR
+CHUNK_SIZE = 4_000        # caracteres por chunk si no se pudo medir el system prompt
+KEEP_ALIVE = "30m"        # mantiene el modelo (y su caché KV) cargado entre chunks
+NUM_CTX    = 8_192        # ventana de contexto pedida a Ollama (tokens)
+NUM_BATCH  = 512          # tokens por bloque de evaluación del prompt
+# Parámetros del runner: deben coincidir en todas las llamadas o Ollama recarga el modelo
+RUNNER_OPTS = {"num_ctx": NUM_CTX, "num_batch": NUM_BATCH}
+LOTE_MAX   = 4            # máximo de chunks por llamada al LLM
+LLENADO_CTX     = 0.8     # fracción de NUM_CTX para el prompt; el resto queda para la respuesta
+CHARS_POR_TOKEN = 4       # aproximación para texto en español
+N_WORKERS  = max(1, (os.cpu_count() or 1) // 4)   # PDFs en paralelo (~4 núcleos por Tesseract)
+CPUS_POR_PDF = max(1, (os.cpu_count() or 1) // N_WORKERS)   # rasterizado y OCR de cada PDF
+
+OLLAMA_HOST    = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_TIMEOUT = 600.0    # segundos sin recibir datos antes de abandonar una llamada
+
+EMBED_MODEL      = "nomic-embed-text"   # embeddings para la caché semántica
+CACHE_SIM        = 0.95                 # similitud coseno mínima para reutilizar respuesta
+CACHE_SAVE_EVERY = 20                   # respuestas nuevas entre volcados a disco
 
 PALI_STOP = {
     "granos", "polínico", "polinico", "trilete",
@@ -48,6 +94,8 @@ PALI_STOP = {
     "fóveado", "estomatita", "tricolpado"
 }
 
+CAMPOS = ["especie_cientifica", "nombre_comun", "uso_precolombino"]
+
 BINOMIO    = re.compile(r"[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+ [a-záéíóúñ]{2,}", re.U)
 CLAVES_USO = re.compile(
     r"\b(aliment|comest|madera|medicin|ritual|tinte|textil|aroma|colorant)", re.I
@@ -80,20 +128,44 @@ Ejemplo de uso inferido:
   }
 ]
 """.strip()
+
+SYSTEM_PROMPT_LOTE = SYSTEM_PROMPT + """
+
+MODO LOTE: recibirás varios fragmentos marcados como "### CHUNK n".
+En lugar de un único arreglo, responde con UN objeto JSON cuyas claves sean
+los números de chunk (como texto) y cuyos valores sean el arreglo de especies
+de ese fragmento, por ejemplo: {"1": [...], "2": []}
+""".rstrip()
+
+# Huella de lo que determina las respuestas guardadas: las cachés del LLM
+# escritas con otro modelo o con otros prompts se descartan al cargarlas.
+FIRMA_LLM = hashlib.blake2b(
+    "\0".join((MODEL_ID, EMBED_MODEL, SYSTEM_PROMPT, SYSTEM_PROMPT_LOTE)).encode("utf-8"),
+    digest_size=16
+).hexdigest()
+# chunk_cache.json guarda registros ya normalizados: depende también del normalizador
+FIRMA_CHUNKS = hashlib.blake2b(f"{FIRMA_LLM}:{NORMALIZA_VERSION}".encode("utf-8"),
+                               digest_size=16).hexdigest()
+
+# Tokens de cada system prompt medidos al precalentar; se pasan como `num_keep`
+# para que Ollama conserve ese prefijo en la caché KV entre llamadas.
+_SYS_TOKENS: Dict[str, int] = {}
 # ╰──────────────────────────────────────────╯
 
 # ╭──────── Logger en modo DEBUG ───────────╮
 # Se registran nuestros propios mensajes a nivel DEBUG, pero se suprime
-# el exceso de verbosidad de librerías como pdfminer/pdfplumber.
+# el exceso de verbosidad de librerías como PIL/pdf2image.
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)  # Asegura que la carpeta exista para el log
 
 # 1) Root logger: INFO (evita inundarnos con DEBUG externos)
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s",
+    format="%(asctime)s | %(levelname)s | %(processName)s | %(message)s",
     handlers=[
-        logging.FileHandler(LOG_PATH, mode="a", encoding="utf-8"),
+        # `delay`: los hijos que reimportan el módulo (spawn) cambian el handler
+        # por la cola antes de escribir, así que nunca abren el fichero
+        logging.FileHandler(LOG_PATH, mode="a", encoding="utf-8", delay=True),
         logging.StreamHandler(sys.stdout)
     ],
     force=True
@@ -107,19 +179,280 @@ for h in logging.getLogger().handlers:
 log.propagate = False
 
 # 3) Silencia librerías ruidosas
-for noisy in ("pdfminer", "pdfplumber", "PIL", "pdf2image"):
+for noisy in ("PIL", "pdf2image"):
     logging.getLogger(noisy).setLevel(logging.WARNING)
+
+
+_LOG_Q = None     # cola de logging del principal, una vez dentro de un proceso hijo
+
+
+def _init_worker(q, sys_tokens: Dict[str, int]) -> None:
+    """Redirige el logging del proceso hijo a la cola del principal y hereda `num_keep`."""
+    global _SYS_TOKENS, _LOG_Q
+    _SYS_TOKENS = sys_tokens
+    _LOG_Q = q
+    if q is None:       # pool abierto desde el propio proceso principal
+        return
+    qh = QueueHandler(q)
+    logging.getLogger().handlers = [qh]
+    log.handlers = [qh]
 # ╰─────────────────────────────────────────╯
 
+# ╭──────────── CLIENTE DE OLLAMA ─────────────╮
+# Un único cliente HTTP por proceso reutiliza la conexión keep-alive entre
+# llamadas. Se crea perezosamente y otra vez tras un fork: los sockets
+# heredados del proceso padre no deben compartirse.
+_CLIENTE: Optional[ollama.Client] = None
+_CLIENTE_PID = 0
+
+
+def cliente() -> ollama.Client:
+    global _CLIENTE, _CLIENTE_PID
+    if _CLIENTE is None or _CLIENTE_PID != os.getpid():
+        _CLIENTE = ollama.Client(
+            host=OLLAMA_HOST,
+            timeout=OLLAMA_TIMEOUT,
+            limits=httpx.Limits(max_connections=N_WORKERS, max_keepalive_connections=N_WORKERS)
+        )
+        _CLIENTE_PID = os.getpid()
+    return _CLIENTE
+# ╰─────────────────────────────────────────────╯
+
+# ╭────────────── CACHÉS DEL LLM ──────────────╮
+# Nivel 1 (_CHUNK_CACHE): chunk idéntico (BLAKE2b) → registros ya normalizados,
+#   en outputs/chunk_cache.json.
+# Nivel 2 (_LLM_CACHE): vecino más cercano por similitud coseno entre
+#   embeddings → respuesta parseada del LLM, en outputs/llm_cache.pkl.
+# Cada fichero lleva su huella (FIRMA_LLM / FIRMA_CHUNKS) y sólo se aprovecha
+# si coincide con la actual.
+# Ambas se cargan en el primer uso. Cada proceso añade lo nuevo a su propia parte
+# (`guarda_cache`, sólo escritura al final) y el principal, único escritor de
+# los ficheros completos, funde las partes con `consolida_cache`.
+
+def _vigente(guardada: Any, firma: str, nombre: str) -> Dict:
+    """Devuelve los datos de una caché cargada sólo si su huella es la actual."""
+    if not isinstance(guardada, dict) or guardada.get("firma") != firma:
+        log.info(f"{nombre} de otro modelo, prompt o formato; se empieza vacía.")
+        return {}
+    return guardada["datos"]
+
+
+def _carga_cache() -> Dict[bytes, Tuple[Optional[np.ndarray], List[Dict[str, Any]]]]:
+    try:
+        with open(CACHE_PATH, "rb") as f:
+            return _vigente(pickle.load(f), FIRMA_LLM, "Caché del LLM")
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning(f"Caché del LLM ilegible ({e}); se empieza vacía.")
+        return {}
+
+
+def _carga_chunk_cache() -> Dict[bytes, List[Dict[str, Any]]]:
+    try:
+        with open(CHUNK_CACHE_PATH, "rb") as f:
+            datos = _vigente(orjson.loads(f.read()), FIRMA_CHUNKS, "Caché de chunks")
+        return {bytes.fromhex(k): v for k, v in datos.items()}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning(f"Caché de chunks ilegible ({e}); se empieza vacía.")
+        return {}
+
+
+# Se cargan en el primer uso: los procesos de OCR importan el módulo pero no
+# necesitan la caché.
+_CHUNK_CACHE: Optional[Dict[bytes, List[Dict[str, Any]]]] = None
+_LLM_CACHE: Optional[Dict[bytes, Tuple[Optional[np.ndarray], List[Dict[str, Any]]]]] = None
+_CACHE_KEYS: List[bytes] = []            # fila i de _CACHE_MAT ↔ _CACHE_KEYS[i]
+_CACHE_MAT: Optional[np.ndarray] = None
+# Entradas aún no volcadas a la parte de este proceso
+_NUEVOS_LLM: Dict[bytes, Tuple[Optional[np.ndarray], List[Dict[str, Any]]]] = {}
+_NUEVOS_CHUNK: Dict[bytes, List[Dict[str, Any]]] = {}
+
+
+def _asegura_caches() -> None:
+    global _CHUNK_CACHE, _LLM_CACHE
+    if _LLM_CACHE is None:
+        _CHUNK_CACHE = _carga_chunk_cache()
+        _LLM_CACHE = _carga_cache()
+
+
+def _chunk_key(chunk: str) -> bytes:
+    return hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).digest()
+
+
+def _copias(registros: List[Dict[str, Any]]) -> Generator[Dict[str, Any], None, None]:
+    # Quien consume añade `archivo_origen`; lo guardado en caché no se toca
+    return (dict(d) for d in registros)
+
+
+def _matriz_cache() -> Optional[np.ndarray]:
+    """(Re)construye la matriz de embeddings sólo cuando la caché ha cambiado."""
+    global _CACHE_KEYS, _CACHE_MAT
+    _asegura_caches()
+    if _CACHE_MAT is None:
+        _CACHE_KEYS = [k for k, (emb, _) in _LLM_CACHE.items() if emb is not None]
+        _CACHE_MAT = np.vstack([_LLM_CACHE[k][0] for k in _CACHE_KEYS]) if _CACHE_KEYS else None
+    return _CACHE_MAT
+
+
+def _embed(chunk: str) -> Optional[np.ndarray]:
+    try:
+        emb = np.asarray(cliente().embeddings(model=EMBED_MODEL, prompt=chunk)["embedding"],
+                         dtype=np.float32)
+    except Exception as e:
+        log.warning(f"   → embedding falló ({e}); sin búsqueda semántica")
+        return None
+    norm = np.linalg.norm(emb)
+    return emb / norm if norm else None
+
+
+def cache_lookup(chunk: str) -> Tuple[Optional[np.ndarray], Optional[List[Dict[str, Any]]]]:
+    """Búsqueda semántica: devuelve (embedding, respuesta en caché o None)."""
+    emb = _embed(chunk)
+    mat = _matriz_cache()
+    if emb is None or mat is None or mat.shape[1] != emb.shape[0]:
+        return emb, None
+
+    sims = mat @ emb
+    i = int(sims.argmax())
+    if sims[i] > CACHE_SIM:
+        log.debug("   → caché semántica (sim=%.3f)", sims[i])
+        return emb, _LLM_CACHE[_CACHE_KEYS[i]][1]
+    return emb, None
+
+
+def _busca(chunk: str, k: bytes) -> Tuple[Optional[np.ndarray], Optional[List[Dict[str, Any]]]]:
+    """Consulta ambos niveles; devuelve (embedding, registros normalizados o None)."""
+    _asegura_caches()
+    if k in _CHUNK_CACHE:
+        log.debug("   → chunk repetido")
+        return None, _CHUNK_CACHE[k]
+    emb, hit = cache_lookup(chunk)
+    if hit is None:
+        return emb, None
+    registros = normaliza_registros(hit)
+    chunk_cache_store(k, registros)
+    return emb, registros
+
+
+def _anota_nuevo() -> None:
+    if len(_NUEVOS_LLM) + len(_NUEVOS_CHUNK) >= CACHE_SAVE_EVERY:
+        guarda_cache()
+
+
+def cache_store(k: bytes, emb: Optional[np.ndarray], data: List[Dict[str, Any]]) -> None:
+    global _CACHE_MAT
+    _asegura_caches()
+    _LLM_CACHE[k] = _NUEVOS_LLM[k] = (emb, data)
+    _CACHE_MAT = None
+    _anota_nuevo()
+
+
+def chunk_cache_store(k: bytes, registros: List[Dict[str, Any]]) -> None:
+    _asegura_caches()
+    _CHUNK_CACHE[k] = _NUEVOS_CHUNK[k] = registros
+    _anota_nuevo()
+
+
+def _escribe_atomico(path: str, datos: bytes) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(datos)
+    os.replace(tmp, path)
+
+
+def guarda_cache() -> None:
+    """Añade las entradas nuevas a la parte de este proceso; coste proporcional a lo nuevo."""
+    if not (_NUEVOS_LLM or _NUEVOS_CHUNK):
+        return
+    ruta = os.path.join(OUTPUT_DIR, f"{CACHE_PARTE}{os.getpid()}.pkl")
+    try:
+        with open(ruta, "ab") as f:
+            pickle.dump((FIRMA_LLM, FIRMA_CHUNKS, _NUEVOS_LLM, _NUEVOS_CHUNK), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        log.warning(f"No se pudo guardar la caché del LLM: {e}")
+        return
+    _NUEVOS_LLM.clear()
+    _NUEVOS_CHUNK.clear()
+
+
+def _lee_parte(ruta: str) -> Generator[Tuple[dict, dict], None, None]:
+    with open(ruta, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def consolida_cache() -> None:
+    """
+    Funde las partes de todos los procesos en los ficheros completos y las borra.
+    Sólo la llama el proceso principal con el pool cerrado, así que no hay
+    escrituras concurrentes que perder.
+    """
+    global _LLM_CACHE, _CHUNK_CACHE, _CACHE_MAT
+    partes = [os.path.join(OUTPUT_DIR, f) for f in os.listdir(OUTPUT_DIR)
+              if f.startswith(CACHE_PARTE) and f.endswith(".pkl")]
+    if not partes:
+        return
+    llm, chunks = _carga_cache(), _carga_chunk_cache()
+    for ruta in partes:
+        try:
+            for firma, firma_chunks, nuevos_llm, nuevos_chunk in _lee_parte(ruta):
+                if firma == FIRMA_LLM:
+                    llm.update(nuevos_llm)
+                if firma_chunks == FIRMA_CHUNKS:
+                    chunks.update(nuevos_chunk)
+        except Exception as e:
+            # Un proceso que murió a mitad de volcado deja el último registro cortado
+            log.warning(f"Parte de caché '{ruta}' incompleta ({e}); se aprovecha lo legible.")
+    try:
+        _escribe_atomico(CACHE_PATH, pickle.dumps({"firma": FIRMA_LLM, "datos": llm},
+                                                  protocol=pickle.HIGHEST_PROTOCOL))
+        _escribe_atomico(CHUNK_CACHE_PATH, orjson.dumps(
+            {"firma": FIRMA_CHUNKS, "datos": {k.hex(): v for k, v in chunks.items()}}))
+    except OSError as e:
+        log.warning(f"No se pudo consolidar la caché del LLM: {e}")
+        return          # las partes se conservan para el próximo arranque
+    for ruta in partes:
+        os.remove(ruta)
+    _LLM_CACHE, _CHUNK_CACHE, _CACHE_MAT = llm, chunks, None
+    log.info(f"Caché del LLM consolidada: {len(llm)} respuestas, {len(chunks)} chunks")
+# ╰─────────────────────────────────────────────╯
+
 # ╭─────────── UTILIDADES DE LIMPIEZA ───────────╮
+# Todas las sustituciones por " " en una sola alternancia: un único barrido
+# del texto en lugar de uno por patrón.
+_CLEAN_RE = re.compile(
+    r"\b(?:página|page)\s*\d+\b"          # números de página
+    r"|tabla\s*\d+(?:\.\d+)?\b"           # referencias a tablas
+    r"|(?-i:\b\d+\s*[x–—]\s*\d+\b)"       # dimensiones (sensible a mayúsculas)
+    r"|[_•·●■◆►▪\-]{2,}"                   # viñetas y separadores
+    r"|\s+",                              # espacios en blanco
+    re.I
+)
+# Términos palinológicos como palabras completas, en un solo barrido en C
+_STOP_RE = re.compile(
+    r"\b(?:" + "|".join(map(re.escape, sorted(PALI_STOP, key=len, reverse=True))) + r")\b",
+    re.I
+)
+# Lo que NFKD aportaba en texto de PDF (ligaduras y caracteres invisibles)
+# como una tabla para `str.translate`, en una sola pasada en C; los espacios
+# Unicode ya los cubre `\s` en _CLEAN_RE. Las vocales acentuadas y la ñ se
+# conservan precompuestas, que es como las escriben BINOMIO, PALI_STOP y _CLEAN_RE.
+_FOLD = str.maketrans({
+    "ﬀ": "ff", "ﬁ": "fi", "ﬂ": "fl", "ﬃ": "ffi", "ﬄ": "ffl", "ﬅ": "st", "ﬆ": "st",
+    "\u00ad": None, "\u200b": None, "\u2060": None, "\ufeff": None,   # guion blando, ancho cero
+})
+
+
 def clean_text(raw: str) -> str:
-    txt = unicodedata.normalize("NFKD", raw)
-    txt = re.sub(r"\s+", " ", txt)
-    txt = re.sub(r"\b(página|page)\s*\d+\b", " ", txt, flags=re.I)
-    txt = re.sub(r"tabla\s*\d+(\.\d+)?\b", " ", txt, flags=re.I)
-    txt = re.sub(r"\b\d+\s*(x|–|—)\s*\d+\b", " ", txt)
-    txt = re.sub(r"[_•·●■◆►▪\-]{2,}", " ", txt)
-    txt = " ".join(w for w in txt.split() if w.lower() not in PALI_STOP)
+    txt = raw.translate(_FOLD)
+    txt = _CLEAN_RE.sub(" ", txt)
+    txt = _STOP_RE.sub(" ", txt)
     return re.sub(r" {2,}", " ", txt).strip()
 # ╰───────────────────────────────────────────────╯
 
@@ -130,74 +463,387 @@ def setup_dirs():
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 
-def extract_text(pdf_path: str) -> str:
+_TESS_API: Optional[PyTessBaseAPI] = None
+
+
+def _ocr_page(ruta: str) -> str:
+    """
+    OCR de una página; cada proceso crea su PyTessBaseAPI una sola vez.
+    Devuelve "" si la página está casi en blanco o su texto no contiene ni un
+    binomio ni una clave de uso (no aportaría chunks).
+    """
+    global _TESS_API
+    with Image.open(ruta) as img:
+        gris = img.convert("L")
+    arr = np.asarray(gris)
+    if arr.std() < BLANCO_STD or (arr < 128).mean() < BLANCO_TINTA:
+        return ""
+
+    if _TESS_API is None:
+        _TESS_API = PyTessBaseAPI(lang=TESS_LANG)
+        atexit.register(_TESS_API.End)
+    _TESS_API.SetImage(gris)
+    txt = _TESS_API.GetUTF8Text()
+    return txt if BINOMIO.search(txt) or CLAVES_USO.search(txt) else ""
+
+
+def _texto_pagina(page: pdfium.PdfPage) -> str:
+    """Capa de texto de una página con PDFium; libera sus recursos nativos al terminar."""
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range()
+    finally:
+        textpage.close()
+        page.close()
+
+
+def extract_pages(pdf_path: str) -> Generator[str, None, bool]:
+    """
+    Entrega el texto del PDF página a página. Usa la capa digital si reúne
+    más de 100 caracteres útiles; si no, recurre al OCR. Sólo se retienen
+    las primeras páginas mientras se decide. Devuelve False si la
+    extracción falló a medias.
+    """
     log.info(f"Procesando {os.path.basename(pdf_path)}")
+    inicio: List[str] = []
+    util = 0
+    digital = False
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            txt = "\n".join(p.extract_text() or "" for p in pdf.pages)
-        if len(txt.strip()) > 100:
-            log.debug("   → texto digital OK")
-            return txt
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            for p in pdf:
+                txt = _texto_pagina(p)
+                if digital:
+                    yield txt
+                    continue
+                inicio.append(txt)
+                util += len(txt.strip())
+                if util > 100:
+                    log.debug("   → texto digital OK")
+                    digital = True
+                    yield from inicio
+                    inicio = []
+        finally:
+            pdf.close()
+        if digital:
+            return True
         log.debug("   → texto escaso; OCR…")
     except Exception as e:
+        if digital:
+            log.warning(f"   → fallo digital a mitad del documento ({e})")
+            return False
         log.warning(f"   → fallo digital ({e}); OCR…")
 
+    # Las páginas se rasterizan a disco y se reparten entre procesos OCR
+    # (Tesseract escala mejor en procesos que en hilos); el orden se conserva.
     try:
-        imgs = convert_from_path(pdf_path, dpi=300)
-        txt = "\n".join(pytesseract.image_to_string(i, lang=TESS_LANG) for i in imgs)
-        log.debug("   → OCR completado")
-        return txt
+        with tempfile.TemporaryDirectory() as tmp, ExitStack() as pila:
+            paginas = convert_from_path(pdf_path, dpi=300, output_folder=tmp,
+                                        paths_only=True, thread_count=CPUS_POR_PDF)
+            if CPUS_POR_PDF > 1 and len(paginas) > 1:
+                # Con spawn cada proceso de OCR reimporta el módulo: su logging
+                # también debe pasar por la cola del principal
+                ex = pila.enter_context(ProcessPoolExecutor(
+                    max_workers=min(CPUS_POR_PDF, len(paginas)),
+                    initializer=_init_worker, initargs=(_LOG_Q, _SYS_TOKENS)))
+                resultados = ex.map(_ocr_page, paginas)
+            else:
+                resultados = map(_ocr_page, paginas)
+            utiles = 0
+            for txt in resultados:
+                if txt:
+                    utiles += 1
+                    yield txt
+        log.debug("   → OCR completado (%d/%d páginas útiles)", utiles, len(paginas))
+        return True
     except Exception as e:
         log.error(f"   → OCR falló: {e}")
-        return ""
+        return False
+
+
+def bloques_limpios(paginas: Iterable[str], size: int) -> Generator[str, None, None]:
+    """Acumula páginas ya limpias hasta reunir al menos `size` caracteres."""
+    buf: List[str] = []
+    n = 0
+    for pagina in paginas:
+        buf.append(pagina)
+        n += len(pagina) + 1
+        if n >= size:
+            yield " ".join(buf)
+            buf, n = [], 0
+    if buf:
+        yield " ".join(buf)
 
 
-def chunk_text(txt: str, size: int) -> Generator[str, None, None]:
-    for i in range(0, len(txt), size):
-        ch = txt[i:i + size]
-        if BINOMIO.search(ch) and CLAVES_USO.search(ch):
-            yield ch
+def _clave_pdf(pdf_path: str) -> str:
+    st = os.stat(pdf_path)
+    return hashlib.blake2b(f"{pdf_path}:{st.st_mtime}:{st.st_size}:{LIMPIEZA_VERSION}".encode("utf-8"),
+                           digest_size=16).hexdigest()
 
 
-def llm_extract(chunk: str) -> List[Dict[str, Any]]:
-    """Envía el chunk al LLM. Se pide salida JSON pura via `format='json'`."""
+def cached_clean(pdf_path: str) -> Generator[str, None, None]:
+    """
+    Páginas limpias del PDF, una por línea en outputs/cache/<clave>.txt.zst.
+    Si el PDF no ha cambiado (ruta, mtime y tamaño) se leen de ahí sin
+    extraer ni hacer OCR; si no, se extraen, se limpian y se guardan. Una
+    extracción fallida o interrumpida no deja caché.
+    """
+    ruta = os.path.join(TEXT_CACHE_DIR, f"{_clave_pdf(pdf_path)}.txt.zst")
+    if os.path.exists(ruta):
+        log.info(f"Procesando {os.path.basename(pdf_path)} (texto en caché)")
+        with open(ruta, "rb") as f, zstd.ZstdDecompressor().stream_reader(f) as r:
+            for linea in io.TextIOWrapper(r, encoding="utf-8"):
+                yield linea.rstrip("\n")
+        return
+
+    os.makedirs(TEXT_CACHE_DIR, exist_ok=True)
+    tmp = f"{ruta}.{os.getpid()}.tmp"
+    completo = False
+    try:
+        with open(tmp, "wb") as f, zstd.ZstdCompressor().stream_writer(f) as w:
+            paginas = extract_pages(pdf_path)
+            while True:
+                try:
+                    pagina = next(paginas)
+                except StopIteration as fin:
+                    completo = bool(fin.value)
+                    break
+                limpio = clean_text(pagina)   # sin saltos de línea: una página por línea
+                if limpio:
+                    w.write(limpio.encode("utf-8") + b"\n")
+                    yield limpio
+        if completo:
+            os.replace(tmp, ruta)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _ventanas(txt: str, size: int) -> Generator[str, None, None]:
+    """
+    Un solo barrido de BINOMIO y otro de CLAVES_USO sobre el texto: cada
+    binomio aún no cubierto abre una ventana de hasta `size` caracteres que
+    empieza `size // 4` antes (sin solaparse con la última enviada), y sólo se
+    envía si contiene una clave de uso. Una ventana descartada no cubre nada:
+    el siguiente binomio abre la suya aunque caiga dentro. El texto sin
+    binomios nunca se envía.
+    """
+    claves = [m.span() for m in CLAVES_USO.finditer(txt)]
+    inicios = [s for s, _ in claves]
+    previo = size // 4
+    fin = 0
+    for m in BINOMIO.finditer(txt):
+        if m.start() < fin:
+            continue
+        ini = max(m.start() - previo, fin)
+        hasta = min(ini + size, len(txt))
+        j = bisect_left(inicios, ini)       # primera clave que empieza en la ventana
+        if j < len(claves) and claves[j][1] <= hasta:
+            fin = hasta
+            yield txt[ini:hasta]
+
+
+def chunk_text(textos: Iterable[str], size: int, k: int = 1) -> Generator[List[str], None, None]:
+    """Trocea cada bloque en ventanas candidatas y las agrupa en lotes de hasta `k`."""
+    lote: List[str] = []
+    for txt in textos:
+        for ch in _ventanas(txt, size):
+            lote.append(ch)
+            if len(lote) == k:
+                yield lote
+                lote = []
+    if lote:
+        yield lote
+
+
+def precalienta_modelo(system: str) -> int:
+    """
+    Carga el modelo con `keep_alive` y deja evaluado el prefijo `system`.
+    Devuelve cuántos tokens ocupa ese prefijo (0 si no se pudo medir).
+
+    `prompt_eval_count` sólo cuenta lo que se evalúa de verdad: si el prefijo
+    ya estaba en la caché KV (otro prompt que lo comparte, o una ejecución
+    anterior dentro de KEEP_ALIVE) saldría casi 0. Por eso se descarga el
+    modelo antes de medir y cada medición parte en frío.
+    """
     try:
-        resp = ollama.chat(
+        cliente().generate(model=MODEL_ID, keep_alive=0)     # descarga: caché KV vacía
+        resp = cliente().chat(
             model=MODEL_ID,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user",   "content": chunk}
-            ],
-            format="json",                       # ¡salida estructurada!
-            options={"temperature": 0.0, "top_p": 0.1}
+            messages=[{"role": "system", "content": system}],
+            options={**RUNNER_OPTS, "num_predict": 1},
+            keep_alive=KEEP_ALIVE
         )
-        raw = resp["message"]["content"]
-        log.debug("Contenido recibido (4000 chars):\n%s", raw[:4000])
-        data = json.loads(raw)
-    except json.JSONDecodeError as e:
+    except Exception as e:
+        log.warning(f"No se pudo precalentar '{MODEL_ID}': {e}")
+        return 0
+    n = int(resp.get("prompt_eval_count") or 0)
+    log.debug("   → system prompt precargado: %d tokens", n)
+    return n
+
+
+def calcula_chunk_size(sys_tokens: int) -> int:
+    """
+    Caracteres por chunk para que un lote completo (system prompt + LOTE_MAX
+    chunks) ocupe ~LLENADO_CTX de la ventana. Sin medición, usa CHUNK_SIZE.
+    """
+    presupuesto = int(NUM_CTX * LLENADO_CTX) - sys_tokens
+    if not sys_tokens or presupuesto <= 0:
+        return CHUNK_SIZE
+    return presupuesto // LOTE_MAX * CHARS_POR_TOKEN
+
+
+def _llm_options(system: str) -> Dict[str, Any]:
+    opts: Dict[str, Any] = {"temperature": 0.0, "top_p": 0.1, **RUNNER_OPTS}
+    if _SYS_TOKENS.get(system):
+        opts["num_keep"] = _SYS_TOKENS[system]
+    return opts
+
+
+def _chat(system: str, user: str) -> Iterator[str]:
+    """Llamada en streaming al LLM con salida JSON; entrega el texto según llega."""
+    stream = cliente().chat(
+        model=MODEL_ID,
+        messages=[
+            {"role": "system", "content": system},
+            {"role": "user",   "content": user}
+        ],
+        format="json",                       # ¡salida estructurada!
+        options=_llm_options(system),
+        keep_alive=KEEP_ALIVE,
+        stream=True
+    )
+    for part in stream:
+        if part.get("done"):
+            # Tokens evaluados en esta llamada; si el prefijo se reutilizó de la
+            # caché KV, no incluye el system prompt
+            log.debug("   → prompt_eval_count=%s", part.get("prompt_eval_count"))
+        # El mensaje final (`done`) llega con contenido vacío
+        if part["message"].get("content"):
+            yield part["message"]["content"]
+
+
+def _stream_json(piezas: Iterator[str], lote: bool = False) -> Generator[Any, None, None]:
+    """
+    Parsea con ijson el JSON que va llegando y entrega cada elemento en cuanto
+    se completa: los elementos de un arreglo (o el objeto entero) en modo
+    simple, o los pares (clave, valor) del objeto en modo lote.
+    """
+    piezas = iter(piezas)
+    inicio = ""
+    for pieza in piezas:
+        inicio += pieza
+        if inicio.strip():
+            break
+
+    sink = ijson.sendable_list()
+    tipo = inicio.lstrip()[:1]
+    if tipo == "{":
+        coro = (ijson.kvitems_coro if lote else ijson.items_coro)(sink, "", use_float=True)
+    elif tipo == "[" and not lote:
+        coro = ijson.items_coro(sink, "item", use_float=True)
+    else:
+        raise ijson.JSONError("se esperaba " + ("un objeto JSON" if lote else "una lista u objeto JSON"))
+
+    for pieza in chain([inicio], piezas):
+        if not pieza:
+            continue        # ijson toma b"" como fin de datos
+        coro.send(pieza.encode("utf-8"))
+        yield from sink
+        del sink[:]
+    coro.close()
+    yield from sink
+
+
+def _a_lista(data: Any) -> Optional[List[Dict[str, Any]]]:
+    """Normaliza la respuesta a lista de dicts; None si no es lista ni objeto."""
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        return None
+    return [d for d in data if isinstance(d, dict)]
+
+
+def _extract_uno(chunk: str, k: bytes, emb: Optional[np.ndarray]) -> Generator[Dict[str, Any], None, None]:
+    """Envía un chunk al LLM (salida JSON via `format='json'`) y entrega registros normalizados."""
+    data: List[Dict[str, Any]] = []
+    registros: List[Dict[str, Any]] = []
+    try:
+        for item in _stream_json(_chat(SYSTEM_PROMPT, chunk)):
+            if not isinstance(item, dict):
+                continue
+            log.debug("   → recibido: %s", item)
+            data.append(item)
+            nuevos = normaliza_registros([item])
+            registros.extend(nuevos)
+            yield from _copias(nuevos)
+    except ijson.JSONError as e:
         log.warning(f"   → JSON inválido: {e}")
-        return []
+        return
     except ollama.ResponseError as e:
         log.error(f"   → Error de Ollama: {e.error}")
-        return []
+        return
     except Exception as e:
         log.error(f"   → Error inesperado: {e}")
-        return []
+        return
 
-    # Normaliza a lista de dicts
-    if isinstance(data, dict):
-        data = [data]
-    if not isinstance(data, list):
-        log.warning("   → El JSON no es lista ni objeto válido; se descarta.")
-        return []
+    cache_store(k, emb, data)
+    chunk_cache_store(k, registros)
 
-    return [d for d in data if isinstance(d, dict)]
+
+def llm_extract_lote(chunks: List[str]) -> Generator[Dict[str, Any], None, None]:
+    """
+    Envía varios chunks en una sola llamada y entrega los registros
+    normalizados de cada chunk a medida que el LLM completa su arreglo. Los
+    chunks que no lleguen bajo su índice (o el resto del lote, si el JSON se
+    rompe o la llamada falla) se reenvían uno a uno.
+    """
+    claves = [_chunk_key(ch) for ch in chunks]
+    consultas = [_busca(ch, k) for ch, k in zip(chunks, claves)]
+    pend = []
+    for i, (_, registros) in enumerate(consultas):
+        if registros is None:
+            pend.append(i)
+        else:
+            yield from _copias(registros)
+
+    hechos = set()
+    if len(pend) > 1:
+        user = "\n\n".join(f"### CHUNK {n}\n{chunks[i]}" for n, i in enumerate(pend, 1))
+        try:
+            for n, valor in _stream_json(_chat(SYSTEM_PROMPT_LOTE, user), lote=True):
+                lst = _a_lista(valor)
+                if not n.isdigit() or not 0 < int(n) <= len(pend) or lst is None:
+                    continue
+                i = pend[int(n) - 1]
+                log.debug("   → recibido CHUNK %s: %d objetos", n, len(lst))
+                cache_store(claves[i], consultas[i][0], lst)
+                registros = normaliza_registros(lst)
+                chunk_cache_store(claves[i], registros)
+                hechos.add(i)
+                yield from _copias(registros)
+        # Sea cual sea el fallo, lo que no llegó se reintenta chunk a chunk
+        except ijson.JSONError as e:
+            log.warning(f"   → JSON de lote inválido ({e}); modo individual")
+        except ollama.ResponseError as e:
+            log.error(f"   → Error de Ollama en el lote ({e.error}); modo individual")
+        except Exception as e:
+            log.error(f"   → Error inesperado en el lote ({e}); modo individual")
+
+    for i in pend:
+        if i not in hechos:
+            yield from _extract_uno(chunks[i], claves[i], consultas[i][0])
+
+
+def _texto(v: Any) -> str:
+    """Sólo los strings cuentan; dicts, listas, números o None equivalen a vacío."""
+    return v.strip() if isinstance(v, str) else ""
 
 
 def normaliza_registros(lst: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
-    Filtra y normaliza registros. Ahora es capaz de manejar tanto objetos
-    simples como objetos que contienen listas de especies.
+    Filtra y normaliza registros. Maneja tanto objetos simples como objetos
+    cuyos campos son listas paralelas de especies (como en la salida de OLMo).
     """
     registros_finales = []
     for item in lst:
@@ -208,85 +854,121 @@ def normaliza_registros(lst: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         comunes = item.get("nombre_comun")
         usos = item.get("uso_precolombino")
 
-        # Caso 1: El valor es una lista (como en la salida de OLMo)
+        # Caso 1: listas paralelas; nombre y uso sólo se toman de listas
         if isinstance(especies, list):
-            for i, especie_nombre in enumerate(especies):
-                nombre_limpio = especie_nombre.strip()
-                if not nombre_limpio:
-                    continue
-
-                try:
-                    nombre_comun_actual = comunes[i] if comunes and i < len(comunes) else ""
-                except (TypeError, IndexError):
-                    nombre_comun_actual = ""
-
-                # Como el uso puede no venir en la lista, lo manejamos con cuidado
-                try:
-                    uso_actual = usos[i] if isinstance(usos, list) and i < len(usos) else ""
-                except (TypeError, IndexError):
-                    uso_actual = ""
-
+            comunes = comunes if isinstance(comunes, list) else []
+            usos = usos if isinstance(usos, list) else []
+            for i, especie in enumerate(especies):
+                nombre_limpio = _texto(especie)
+                uso_actual = _texto(usos[i]) if i < len(usos) else ""
                 # Solo añadimos si tenemos especie y uso
                 if nombre_limpio and uso_actual:
-                     registros_finales.append({
+                    registros_finales.append({
                         "especie_cientifica": nombre_limpio,
-                        "nombre_comun": nombre_comun_actual.strip(),
-                        "uso_precolombino": uso_actual.strip()
+                        "nombre_comun": _texto(comunes[i]) if i < len(comunes) else "",
+                        "uso_precolombino": uso_actual
                     })
 
-        # Caso 2: El valor es un texto simple (el comportamiento normal)
+        # Caso 2: el valor es un texto simple (el comportamiento normal)
         elif isinstance(especies, str):
             nombre_limpio = especies.strip()
-            # Aseguramos que 'usos' no sea una lista aquí
-            uso_limpio = (usos if isinstance(usos, str) else "") or ""
-
-            if nombre_limpio and uso_limpio.strip() and nombre_limpio.lower() not in {"", "no especificado"}:
+            uso_limpio = _texto(usos)
+            if nombre_limpio and uso_limpio and nombre_limpio.lower() != "no especificado":
                 registros_finales.append({
                     "especie_cientifica": nombre_limpio,
-                    "nombre_comun": (item.get("nombre_comun") or "").strip(),
-                    "uso_precolombino": uso_limpio.strip()
+                    "nombre_comun": _texto(comunes),
+                    "uso_precolombino": uso_limpio
                 })
 
     return registros_finales
+
+
+def process_pdf(pdf_name: str, size: int = CHUNK_SIZE) -> List[Dict[str, Any]]:
+    """Extrae, limpia y envía al LLM un PDF; devuelve sus registros normalizados."""
+    bloques = bloques_limpios(cached_clean(os.path.join(PDF_DIR, pdf_name)), size)
+
+    registros: List[Dict[str, Any]] = []
+    idx = 0
+    try:
+        for lote in chunk_text(bloques, size, LOTE_MAX):
+            for ch in lote:
+                idx += 1
+                log.debug("   → CHUNK %d [%d chars]: %s", idx, len(ch),
+                          shorten(ch, width=120, placeholder="…"))
+            for d in llm_extract_lote(lote):
+                d["archivo_origen"] = pdf_name
+                registros.append(d)
+    finally:
+        guarda_cache()      # lo ya respondido se conserva aunque el PDF falle
+    log.info(f"   → {len(registros)} registros válidos en {pdf_name}")
+    return registros
 # ╰───────────────────────────────────────────────╯
 
 # ╭──────────────────── MAIN ─────────────────────╮
 
 def main():
     setup_dirs()
+    consolida_cache()       # partes que dejó una ejecución interrumpida
     pdfs = [f for f in os.listdir(PDF_DIR) if f.lower().endswith(".pdf")]
     if not pdfs:
         log.error(f"No hay PDFs en '{PDF_DIR}'.")
         return
 
-    registros: List[Dict[str, Any]] = []
-
-    for pdf in tqdm(pdfs, desc="PDFs"):
-        full = clean_text(extract_text(os.path.join(PDF_DIR, pdf)))
-        if not full:
-            continue
-
-        for idx, ch in enumerate(chunk_text(full, CHUNK_SIZE), 1):
-            log.debug("   → CHUNK %d [%d chars]: %s", idx, len(ch),
-                      shorten(ch, width=120, placeholder="…"))
-            datos = normaliza_registros(llm_extract(ch))
-            for d in datos:
-                d["archivo_origen"] = pdf
-            registros.extend(datos)
-
-        log.info(
-            f"   → {len([r for r in registros if r['archivo_origen'] == pdf])} registros válidos en {pdf}")
-
-    if not registros:
+    # Cada medición descarga el modelo; el prompt de lote va al final para
+    # que sea el que queda en la caché KV
+    sys_tokens = {p: precalienta_modelo(p) for p in (SYSTEM_PROMPT, SYSTEM_PROMPT_LOTE)}
+    size = calcula_chunk_size(sys_tokens[SYSTEM_PROMPT_LOTE])
+    log.info(f"Chunks de {size} caracteres, hasta {LOTE_MAX} por llamada")
+    columnas = CAMPOS + ["archivo_origen"]
+    fila = 1
+
+    # Cada PDF se procesa en un proceso aparte; los logs de los hijos
+    # viajan por una cola y los escribe un único listener en el principal.
+    # Los registros de cada PDF se escriben (JSONL y Excel) en cuanto llegan;
+    # `constant_memory` vuelca cada fila a disco, así que la memoria no crece.
+    # El libro se crea con los primeros registros: una ejecución sin
+    # resultados no pisa el Excel anterior.
+    with open(JSONL_PATH, "wb") as out, \
+         mp.Manager() as manager, \
+         ExitStack() as pila:
+        hoja = None
+        q = manager.Queue()
+        listener = QueueListener(q, *log.handlers)
+        listener.start()
+        try:
+            with ProcessPoolExecutor(max_workers=N_WORKERS,
+                                     initializer=_init_worker,
+                                     initargs=(q, sys_tokens)) as ex:
+                futs = {ex.submit(process_pdf, pdf, size): pdf for pdf in pdfs}
+                for fut in tqdm(as_completed(futs), total=len(futs), desc="PDFs"):
+                    try:
+                        registros = fut.result()
+                    except Exception as e:
+                        log.error(f"   → {futs[fut]} falló: {e}")
+                        continue
+                    if not registros:
+                        continue
+                    for d in registros:
+                        out.write(orjson.dumps(d) + b"\n")
+                    # `archivo_origen` está en la clave: deduplicar por PDF basta
+                    df = pd.DataFrame(registros, columns=columnas).drop_duplicates()
+                    print(df.to_string())
+                    if hoja is None:
+                        libro = pila.enter_context(
+                            xlsxwriter.Workbook(OUT_FILE, {"constant_memory": True}))
+                        hoja = libro.add_worksheet()
+                        hoja.write_row(0, 0, columnas)
+                    for reg in df.itertuples(index=False):
+                        hoja.write_row(fila, 0, reg)
+                        fila += 1
+        finally:
+            listener.stop()
+            consolida_cache()
+
+    if fila == 1:
         log.warning("Sin especies encontradas.")
         return
-
-    df = pd.DataFrame(registros).drop_duplicates(
-        subset=["especie_cientifica", "nombre_comun", "uso_precolombino", "archivo_origen"]
-    )
-    print(df.to_string())
-    df.to_excel(OUT_FILE, index=False)
-    log.info(f"✅ Guardado {len(df)} filas en '{OUT_FILE}'")
+    log.info(f"✅ Guardado {fila - 1} filas en '{OUT_FILE}'")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,19 @@
+import pytest
+
+ext = pytest.importorskip("extractor_especies_debug")
+
+
+def test_pieza_vacia_final_no_corta_el_arreglo():
+    # Ollama cierra el stream con un mensaje `done` de contenido vacío
+    body = '[{"especie_cientifica": "Zea mays", "uso_precolombino": "Alimento"}]'
+    assert list(ext._stream_json(iter([body, ""]))) == [
+        {"especie_cientifica": "Zea mays", "uso_precolombino": "Alimento"}
+    ]
+
+
+def test_pieza_vacia_final_en_modo_lote():
+    body = '{"1": [{"especie_cientifica": "Zea mays"}], "2": []}'
+    assert list(ext._stream_json(iter(['{"1"', body[4:], ""]), lote=True)) == [
+        ("1", [{"especie_cientifica": "Zea mays"}]),
+        ("2", []),
+    ]
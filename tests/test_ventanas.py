@@ -0,0 +1,16 @@
+import pytest
+
+ext = pytest.importorskip("extractor_especies_debug")
+
+
+def test_binomio_dentro_de_ventana_descartada():
+    # "Quercus robur" abre una ventana sin clave de uso; "Zea mays" cae dentro
+    # pero su propia ventana sí llega hasta "alimento".
+    txt = "x" * 1000 + "Quercus robur" + "x" * 2946 + "Zea mays como alimento" + "x" * 3000
+    ventanas = list(ext._ventanas(txt, 4000))
+    assert len(ventanas) == 1
+    assert "Zea mays como alimento" in ventanas[0]
+
+
+def test_sin_clave_de_uso_no_hay_ventanas():
+    assert list(ext._ventanas("Quercus robur " * 500, 4000)) == []